@@ -15,8 +15,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from parsley import makeGrammar
+import functools
+import re
 import subprocess
+try:
+    from sys import intern
+except ImportError:
+    # Python 2 has intern as a builtin.
+    pass
 
 
 debversion_grammar = """
@@ -31,23 +37,86 @@ upstream_hyphen = epoch?:e <upstreamver>:u '-' <debver>:d -> (e or '0', u, d)
 debversion = upstream_hyphen | upstream_no_hyphen
 """
 
-debversion_compiled = makeGrammar(debversion_grammar, {})
-
-
-grammar = debversion_grammar + """
-rules = rule*
-rule = <name>:name selector?:selector version?:version '\n' -> (
-    name, selector or [], version or [])
-lowercase = ('a'|'b'|'c'|'d'|'e'|'f'|'g'|'h'|'i'|'j'|'k'|'l'|'m'|'n'|'o'|'p'
-            |'q'|'r'|'s'|'t'|'u'|'v'|'w'|'x'|'y'|'z')
-name = (lowercase|digit):start (lowercase|digit|'.'|'+'|'-')+:rest
-ws = ' '+
-profile = ('!'?:neg <(lowercase|digit|':')+>:name) -> (neg!='!', name)
-selector = ws '[' profile:p1 (ws profile)*:p2 ']' -> [p1] + p2
-oneversion = <('<=' | '<' | '!=' | '==' | '>=' | '>')>:rel <debversion>:v -> (
-    rel, v)
-version = ws oneversion:v1 (',' oneversion)*:v2 -> [v1] + v2
-"""
+# Compiled on first use by _parse_debversion: building the grammar is by far
+# the most expensive part of importing this module, and it is only needed to
+# order versions.
+_debversion_compiled = None
+
+
+_OS_RELEASE = '/etc/os-release'
+# Holds the detected distribution name, see Depends._detect_platform.
+_PLATFORM_CACHE = {}
+
+# A rule is a package name, optionally followed by a [] enclosed list of
+# one or more profile selectors, optionally followed by comma separated
+# version constraints. Each part is separated from the previous one by
+# spaces. Profile names may contain '-', '.' and '_' as os-release IDs such
+# as opensuse-leap do.
+_RULE_RE = re.compile(
+    r'^(?P<name>[a-z0-9][a-z0-9.+-]+)'
+    r'(?: +\[(?P<selectors>!?[a-z0-9:._-]+(?: +!?[a-z0-9:._-]+)*)\])?'
+    r'(?: +(?P<versions>[<>!=]\S*))?\n?\Z')
+# The same pattern for lines read as bytes, which on Python 3 are matched
+# without decoding; only the captured tokens are decoded.
+_RULE_BYTES_RE = re.compile(_RULE_RE.pattern.encode('ascii'))
+# An operator followed by a Debian version, accepting the same versions as
+# debversion_grammar: an optional epoch, then an upstream version starting
+# with a digit, then an optional revision after the last hyphen.
+_CONSTRAINT_RE = re.compile(
+    r'^(<=|<|!=|==|>=|>)'
+    r'((?:\d+:|(?!\d+:))\d'
+    r'(?:(?:[A-Za-z0-9.+~:]|-(?=[A-Za-z0-9.+~:]*-[A-Za-z0-9.+~]))*'
+    r'-[A-Za-z0-9.+~]+|[A-Za-z0-9.+~:]*))$')
+# Maps each version constraint operator to a function of the installed and
+# constraint versions. Equality is a plain string comparison; ordering needs
+# the versions to be parsed.
+_COMPARATORS = {
+    '==': lambda installed, constraint: installed == constraint,
+    '!=': lambda installed, constraint: installed != constraint,
+    '<': lambda installed, constraint: _cmp_version(installed, constraint) < 0,
+    '<=': lambda installed, constraint: (
+        _cmp_version(installed, constraint) <= 0),
+    '>': lambda installed, constraint: _cmp_version(installed, constraint) > 0,
+    '>=': lambda installed, constraint: (
+        _cmp_version(installed, constraint) >= 0),
+}
+# Splits a version segment into alternating runs of non-digits and digits.
+_SEGMENT_RE = re.compile(r'(\D*)(\d*)')
+
+
+def _resolve_constraints(versions):
+    """Resolve (operator, version) constraints for checking.
+
+    :return: A list of (compare, operator, version) tuples, where compare is
+        the comparison function for operator.
+    """
+    return [(_COMPARATORS[operator], operator, version)
+            for operator, version in versions]
+
+
+class _Rule(tuple):
+    """A (name, selectors, versions) rule as parsed from a requirements list.
+
+    It compares equal to the plain tuple, and additionally carries its
+    resolved version constraints so that checking it needs no operator
+    lookups.
+    """
+
+    def __new__(cls, rule):
+        self = super(_Rule, cls).__new__(cls, rule)
+        self.constraints = _resolve_constraints(rule[2])
+        return self
+
+
+def _intern(name):
+    """Intern name if it is a native str.
+
+    Python 2 can only intern str, not unicode, so other strings are returned
+    unchanged.
+    """
+    if type(name) is str:
+        return intern(name)
+    return name
 
 
 class Depends(object):
@@ -57,11 +126,76 @@ class Depends(object):
         """Construct a Depends instance.
 
         :param depends_string: The string description of the requirements that
-            need to be satisfied. See the bindep README.rst for syntax for the
-            requirements list.
+            need to be satisfied, or an iterable of its lines such as an open
+            file. See the bindep README.rst for syntax for the requirements
+            list.
         """
-        parser = makeGrammar(grammar, {})(depends_string)
-        self._rules = parser.rules()
+        if hasattr(depends_string, 'splitlines'):
+            depends_string = depends_string.splitlines(True)
+        self._rules = []
+        self._platform_profiles = None
+        # Each profile named by a selector is given its own bit, and each
+        # rule a (positive, negative) pair of masks of those bits, so that
+        # selectors can be evaluated with a few integer operations.
+        self._selector_ids = {}
+        self._masks = []
+        for line in depends_string:
+            rule = self._parse_line(line)
+            self._rules.append(rule)
+            self._masks.append(self._selector_masks(rule[1]))
+
+    def _selector_masks(self, selectors):
+        """Return the (positive, negative) profile masks for selectors."""
+        positive = 0
+        negative = 0
+        for sense, profile in selectors:
+            bit = self._selector_ids.setdefault(
+                profile, 1 << len(self._selector_ids))
+            if sense:
+                positive |= bit
+            else:
+                negative |= bit
+        return positive, negative
+
+    def _parse_line(self, line):
+        """Parse a single line of the requirements list into a rule.
+
+        :return: A tuple of the package name, a list of (sense, profile)
+            selectors and a list of (operator, version) constraints.
+        """
+        # On Python 3 lines read in binary mode are bytes, matched without
+        # decoding. On Python 2 bytes is str, which like unicode is matched as
+        # text.
+        binary = bytes is not str and isinstance(line, bytes)
+        if binary:
+            match = _RULE_BYTES_RE.match(line)
+        else:
+            match = _RULE_RE.match(line)
+        if match is None:
+            raise ValueError("Invalid requirement: %r" % (line,))
+        name, selectors, versions = match.group(
+            'name', 'selectors', 'versions')
+        if binary:
+            name, selectors, versions = [
+                token and token.decode('utf-8')
+                for token in (name, selectors, versions)]
+        selector = []
+        if selectors:
+            for profile in selectors.split():
+                if profile.startswith('!'):
+                    selector.append((False, _intern(profile[1:])))
+                else:
+                    selector.append((True, _intern(profile)))
+        version = []
+        if versions:
+            for constraint in versions.split(','):
+                match = _CONSTRAINT_RE.match(constraint)
+                if match is None:
+                    raise ValueError(
+                        "Invalid version constraint %r in requirement %r" % (
+                            constraint, line))
+                version.append(match.group(1, 2))
+        return _Rule((_intern(name), selector, version))
 
     def active_rules(self, profiles):
         """Return the rules active given profiles.
@@ -69,44 +203,35 @@ class Depends(object):
         :param profiles: A list of profiles to consider active. This should
             include platform profiles - they are not automatically included.
         """
-        profiles = set(profiles)
+        active = 0
+        for profile in profiles:
+            active |= self._selector_ids.get(profile, 0)
         result = []
-        for rule in self._rules:
-            # Have we seen any positive selectors - if not, the absence of
-            # negatives means we include the rule, but if we any positive
-            # selectors we need a match.
-            positive = False
-            match_found = False
-            negative = False
-            for sense, profile in rule[1]:
-                if sense:
-                    positive = True
-                    if profile in profiles:
-                        match_found = True
-                else:
-                    if profile in profiles:
-                        negative = True
-                        break
-            if not negative and (match_found or not positive):
+        for rule, (positive, negative) in zip(self._rules, self._masks):
+            # A matching negative selector always excludes the rule.
+            # Otherwise, if there are any positive selectors, one of them
+            # needs to match.
+            if not negative & active and (not positive or positive & active):
                 result.append(rule)
         return result
 
-    def check_rules(self, rules):
+    def check_rules(self, rules, stop_on_first=False):
         """Evaluate rules against the local environment.
 
         :param rules: A list of rules, as returned by active_rules.
+        :param stop_on_first: If True, stop checking at the first unsatisfied
+            rule, so that only it is reported.
         :return: A list of unsatisfied rules.
         """
         missing = set()
         incompatible = []
-        for rule in rules:
-            installed = self.platform.get_pkg_version(rule[0])
-            if not installed:
-                missing.add(rule[0])
-            for operator, constraint in rule[2]:
-                if not _eval(installed, operator, constraint):
-                    incompatible.append(
-                        (rule[0], '%s%s' % (operator, constraint), installed))
+        for kind, problem in self._unsatisfied(rules):
+            if kind == "missing":
+                missing.add(problem)
+            else:
+                incompatible.append(problem)
+            if stop_on_first:
+                break
         result = []
         if missing:
             result.append(("missing", sorted(missing)))
@@ -114,21 +239,73 @@ class Depends(object):
             result.append(("badversion", incompatible))
         return result
 
+    def _unsatisfied(self, rules):
+        """Yield a (kind, problem) tuple for each unsatisfied rule in turn."""
+        if not rules:
+            return
+        packages = self.platform.installed_packages()
+        for rule in rules:
+            installed = packages.get(rule[0])
+            if not installed:
+                yield "missing", rule[0]
+                continue
+            if isinstance(rule, _Rule):
+                constraints = rule.constraints
+            else:
+                constraints = _resolve_constraints(rule[2])
+            for compare, operator, constraint in constraints:
+                if not compare(installed, constraint):
+                    yield "badversion", (
+                        rule[0], '%s%s' % (operator, constraint), installed)
+
     def profiles(self):
-        profiles = set()
-        for rule in self._rules:
-            for _, selector in rule[1]:
-                profiles.add(selector)
-        return sorted(profiles)
+        return sorted(self._selector_ids)
 
     def platform_profiles(self):
-        distro = subprocess.check_output(
-            ["lsb_release", "-si"], stderr=subprocess.STDOUT).strip().lower()
-        atoms = set([distro])
-        if distro in ["debian", "ubuntu"]:
-            atoms.add("dpkg")
-            self.platform = Dpkg()
-        return ["platform:%s" % (atom,) for atom in sorted(atoms)]
+        """Return the profiles describing the platform bindep is running on.
+
+        The platform is only detected once per instance; later calls return
+        the same profiles.
+        """
+        if self._platform_profiles is None:
+            distro = self._detect_platform()
+            atoms = set([distro])
+            if distro in ["debian", "ubuntu"]:
+                atoms.add("dpkg")
+                self.platform = Dpkg()
+            self._platform_profiles = [
+                "platform:%s" % (atom,) for atom in sorted(atoms)]
+        return list(self._platform_profiles)
+
+    def _detect_platform(self):
+        """Return the lower cased name of the running distribution.
+
+        This is read from the ID field of /etc/os-release where that exists,
+        which is much cheaper than running lsb_release. The answer is cached
+        for the life of the process.
+        """
+        try:
+            return _PLATFORM_CACHE['distro']
+        except KeyError:
+            pass
+        distro = None
+        try:
+            with open(_OS_RELEASE, 'rt') as os_release:
+                for line in os_release:
+                    if line.startswith('ID='):
+                        distro = line.split('=', 1)[1].strip().strip('"\'')
+                        break
+        except IOError:
+            pass
+        if not distro:
+            distro = subprocess.check_output(
+                ["lsb_release", "-si"], stderr=subprocess.STDOUT).strip()
+            if not isinstance(distro, str):
+                # Python 3 returns bytes.
+                distro = distro.decode('utf-8')
+        distro = distro.lower()
+        _PLATFORM_CACHE['distro'] = distro
+        return distro
 
 
 class Platform(object):
@@ -139,54 +316,57 @@ class Platform(object):
 
         :return: None if pkg_name is not installed, or a version otherwise.
         """
-        raise NotImplementedError(self.get_pkg_version)
+        return self.installed_packages().get(pkg_name)
+
+    def installed_packages(self):
+        """Find all installed packages.
+
+        :return: A dict mapping the name of each installed package to its
+            version. Callers must not modify it.
+        """
+        raise NotImplementedError(self.installed_packages)
 
 
 class Dpkg(Platform):
     """dpkg specific platform implementation.
 
     This currently shells out to dpkg, it could in future use python-apt.
+    The status of every package is read with a single dpkg-query call the
+    first time it is needed and cached for the lifetime of the instance.
     """
 
-    def get_pkg_version(self, pkg_name):
-        try:
-            output = subprocess.check_output(
-                ["dpkg-query", "-W", "-f",
-                 "${binary:Package} ${Status} ${Version}\n",
-                 pkg_name], stderr=subprocess.STDOUT)
-        except subprocess.CalledProcessError as e:
-            if (e.returncode == 1 and
-                e.output.startswith('dpkg-query: no packages found')):
-                return None
-            raise
-        # output looks like
-        # name planned status install-status version
-        output = output.strip()
-        elements = output.split(' ')
-        if elements[3] != 'installed':
-            return None
-        return elements[4]
-
-
-def _eval_diff(operator, diff):
-    """Return the boolean result for operator given diff.
-
-    :param diff: An int with negative values meaning the right most parameter
-        to the _eval function was greater than the left most parameter.
-    :return: True if the operator was satisfied.
-    """
-    if operator == "==":
-        return diff == 0
-    if operator == "!=":
-        return diff != 0
-    if operator == "<":
-        return diff < 0
-    if operator == "<=":
-        return diff <= 0
-    if operator == ">":
-        return diff > 0
-    if operator == ">=":
-        return diff >= 0
+    def __init__(self):
+        self._versions = None
+
+    def installed_packages(self):
+        if self._versions is None:
+            self._versions = self._load_all()
+        return self._versions
+
+    def _load_all(self):
+        """Query dpkg for every package it knows about.
+
+        :return: A dict mapping the names of installed packages to their
+            versions.
+        """
+        # stderr is left alone so that any warnings are shown to the user
+        # rather than mixed into the package list.
+        output = subprocess.check_output(
+            ["dpkg-query", "-W", "-f", "${Package} ${Status} ${Version}\n"])
+        if not isinstance(output, str):
+            # Python 3 returns bytes.
+            output = output.decode('utf-8')
+        versions = {}
+        for line in output.splitlines():
+            # line looks like
+            # name planned status install-status version
+            elements = line.split(' ', 4)
+            if len(elements) != 5:
+                continue
+            name, _, _, status, version = elements
+            if status == 'installed':
+                versions[name] = version
+        return versions
 
 
 def _to_ord(character):
@@ -216,65 +396,96 @@ def _to_ord(character):
 
 
 def _cmp_nondigit(left, right):
-    l_ord = _to_ord(left)
-    r_ord = _to_ord(right)
-    return l_ord - r_ord
+    """Compare two runs of non-digit characters lexically."""
+    for offset in range(max(len(left), len(right))):
+        diff = (_to_ord(left[offset:offset+1]) -
+                _to_ord(right[offset:offset+1]))
+        if diff:
+            return diff
+    return 0
 
 
-def _find_int(a_str, offset):
-    """Find an int within a_str.
+def _split_segment(segment):
+    """Split a version segment into (non-digit run, number) pairs.
 
-    :return: The int and the offset of the first character after the int.
+    :return: A list of pairs, with an absent number given as 0.
     """
-    if offset == len(a_str):
-        return 0, offset
-    initial_offset = offset
-    while offset < len(a_str):
-        offset += 1
-        try:
-            result = int(a_str[initial_offset:offset])
-        except ValueError:
-            # past the end of the decimal bit
-            offset -= 1
-            break
-    return int(a_str[initial_offset:offset]), offset
+    return [(text, int(digits or 0))
+            for text, digits in _SEGMENT_RE.findall(segment)
+            if text or digits]
+
+
+def _parse_debversion(version):
+    """Parse version into an (epoch, upstream, debian revision) tuple."""
+    global _debversion_compiled
+    if _debversion_compiled is None:
+        from parsley import makeGrammar
+        _debversion_compiled = makeGrammar(debversion_grammar, {})
+    return _debversion_compiled(version).debversion()
+
+
+def _memoize(maxsize):
+    """Cache the results of a function of hashable positional arguments.
+
+    A minimal stand-in for functools.lru_cache, which Python 2 lacks: rather
+    than evicting the least recently used result, the whole cache is emptied
+    once it holds maxsize results.
+    """
+    def decorator(function):
+        cache = {}
+
+        @functools.wraps(function)
+        def wrapper(*args):
+            try:
+                return cache[args]
+            except KeyError:
+                pass
+            if len(cache) >= maxsize:
+                cache.clear()
+            result = cache[args] = function(*args)
+            return result
+        wrapper.cache_clear = cache.clear
+        return wrapper
+    return decorator
 
 
 def _eval(installed, operator, constraint):
-    if operator == "==":
-        return installed == constraint
-    if operator == "!=":
-        return installed != constraint
-    constraint_parsed = debversion_compiled(constraint).debversion()
-    installed_parsed = debversion_compiled(installed).debversion()
+    return _COMPARATORS[operator](installed, constraint)
+
+
+@_memoize(maxsize=4096)
+def _cmp_version(installed, constraint):
+    """Compare two Debian versions.
+
+    :return: An int, negative if installed is older than constraint, 0 if
+        they are the same version and positive if installed is newer.
+    """
+    if installed == constraint:
+        # Identical versions are equal without needing to be parsed.
+        return 0
+    constraint_parsed = _parse_debversion(constraint)
+    installed_parsed = _parse_debversion(installed)
     diff = int(installed_parsed[0]) - int(constraint_parsed[0])
     if diff:
-        return _eval_diff(operator, diff)
+        return diff
     diff = _cmp_segment(installed_parsed[1], constraint_parsed[1])
     if diff:
-        return _eval_diff(operator, diff)
-    diff = _cmp_segment(installed_parsed[2], constraint_parsed[2])
-    return _eval_diff(operator, diff)
+        return diff
+    return _cmp_segment(installed_parsed[2], constraint_parsed[2])
 
 
 def _cmp_segment(l_str, r_str):
-    r_offset = 0
-    l_offset = 0
-    while (r_offset < len(r_str)) or (l_offset < len(l_str)):
-        r_char = r_str[r_offset:r_offset+1]
-        l_char = l_str[l_offset:l_offset+1]
-        if ((not r_char or r_char.isdigit())
-            and (not l_char or l_char.isdigit())):
-            l_int, l_offset = _find_int(l_str, l_offset)
-            r_int, r_offset = _find_int(r_str, r_offset)
-            diff = l_int - r_int
-            if diff:
-                return diff
-        diff = _cmp_nondigit(l_char, r_char)
+    # Per the Debian policy the segments are compared as alternating runs of
+    # non-digits, compared lexically, and digits, compared numerically.
+    l_parts = _split_segment(l_str)
+    r_parts = _split_segment(r_str)
+    for offset in range(max(len(l_parts), len(r_parts))):
+        l_text, l_int = l_parts[offset] if offset < len(l_parts) else ('', 0)
+        r_text, r_int = r_parts[offset] if offset < len(r_parts) else ('', 0)
+        diff = _cmp_nondigit(l_text, r_text)
+        if diff:
+            return diff
+        diff = l_int - r_int
         if diff:
             return diff
-        if not l_char.isdigit() and l_offset < len(l_str):
-            l_offset += 1
-        if not r_char.isdigit() and r_offset < len(r_str):
-            r_offset += 1
     return 0
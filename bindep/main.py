@@ -16,30 +16,71 @@
 # limitations under the License.
 
 import logging
-import optparse
 import sys
 
-from bindep.depends import Depends
 
+USAGE = """\
+Usage: bindep [options] [profile ...]
 
-logging.basicConfig(
-    stream=sys.stdout, level=logging.INFO, format="%(message)s")
+Options:
+  -h, --help   show this help message and exit
+  --profiles   List the platform and configuration profiles.
+  --fail-fast  Stop at the first unsatisfied requirement."""
+
+
+def _report_missing(packages):
+    logging.info("Missing packages:\n    %s", " ".join(packages))
+
+
+def _report_badversion(incompatible):
+    logging.info(
+        "Bad versions of installed packages:\n%s",
+        "\n".join(
+            "    %s version %s does not match %s" % (pkg, version, constraint)
+            for pkg, constraint, version in incompatible))
+
+
+# How to report each kind of error returned by Depends.check_rules.
+_ERROR_REPORTERS = {
+    'missing': _report_missing,
+    'badversion': _report_badversion,
+}
 
 
 def main(depends=None):
+    if not logging.root.handlers:
+        logging.basicConfig(
+            stream=sys.stdout, level=logging.INFO, format="%(message)s")
+
+    # Arguments are few and simple, so they are checked by hand rather than
+    # with optparse: this keeps startup cheap for a command usually run as a
+    # quick pre-flight check.
+    list_profiles = False
+    fail_fast = False
+    args = []
+    for arg in sys.argv[1:]:
+        if arg in ('-h', '--help'):
+            logging.info(USAGE)
+            return 0
+        elif arg == '--profiles':
+            list_profiles = True
+        elif arg == '--fail-fast':
+            fail_fast = True
+        elif arg.startswith('-'):
+            logging.error(
+                "%s\n\nbindep: error: no such option: %s", USAGE, arg)
+            return 2
+        else:
+            args.append(arg)
     if depends is None:
+        from bindep.depends import Depends
         try:
-            content = open('other-requirements.txt', 'rt').read()
+            with open('other-requirements.txt', 'rb') as requirements:
+                depends = Depends(requirements)
         except IOError:
             logging.error('No other-requirements.txt file found.')
             return 1
-        depends = Depends(content)
-    parser = optparse.OptionParser()
-    parser.add_option(
-        "--profiles", action="store_true",
-        help="List the platform and configuration profiles.")
-    opts, args = parser.parse_args()
-    if opts.profiles:
+    if list_profiles:
         logging.info("Platform profiles:")
         for profile in depends.platform_profiles():
             logging.info("%s", profile)
@@ -54,17 +95,9 @@ def main(depends=None):
             profiles = ["default"]
         profiles = profiles + depends.platform_profiles()
         rules = depends.active_rules(profiles)
-        errors = depends.check_rules(rules)
-        for error in errors:
-            if error[0] == 'missing':
-                logging.info("Missing packages:")
-                logging.info("    %s", " ".join(error[1]))
-            if error[0] == 'badversion':
-                logging.info("Bad versions of installed packages:")
-                for pkg, constraint, version in error[1]:
-                    logging.info(
-                        "    %s version %s does not match %s",
-                        pkg, version, constraint)
+        errors = depends.check_rules(rules, stop_on_first=fail_fast)
+        for kind, problem in errors:
+            _ERROR_REPORTERS[kind](problem)
         if errors:
             return 1
     return 0
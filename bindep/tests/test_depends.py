@@ -18,7 +18,9 @@
 import subprocess
 from textwrap import dedent
 
-import mox
+from fixtures import MonkeyPatch
+from fixtures import TempDir
+import mock
 from testtools.matchers import Contains
 from testtools.matchers import Equals
 from testtools.matchers import MatchesSetwise
@@ -26,12 +28,24 @@ from testtools import TestCase
 
 from bindep.depends import Depends
 from bindep.depends import Dpkg
+from bindep.depends import _cmp_version
+from bindep.depends import _COMPARATORS
 from bindep.depends import _eval
 from bindep.depends import Platform
 
 
 class TestDepends(TestCase):
 
+    def setUp(self):
+        super(TestDepends, self).setUp()
+        self.useFixture(MonkeyPatch('bindep.depends._PLATFORM_CACHE', {}))
+
+    def _write_os_release(self, content):
+        path = self.useFixture(TempDir()).path + '/os-release'
+        with open(path, 'wt') as os_release:
+            os_release.write(content)
+        self.useFixture(MonkeyPatch('bindep.depends._OS_RELEASE', path))
+
     def test_empty_file(self):
         depends = Depends("")
         self.assertEqual([], depends.profiles())
@@ -40,29 +54,44 @@ class TestDepends(TestCase):
         depends = Depends("")
         self.assertIsInstance(depends.platform_profiles(), list)
 
-    def _mock_lsb(self):
-        mocker = mox.Mox()
-        mocker.StubOutWithMock(subprocess, "check_output")
-        subprocess.check_output(
-            ["lsb_release", "-si"],
-            stderr=subprocess.STDOUT).AndReturn("Ubuntu\n")
-        mocker.ReplayAll()
-        self.addCleanup(mocker.VerifyAll)
-        self.addCleanup(mocker.UnsetStubs)
-
-    def test_detects_ubuntu(self):
-        self._mock_lsb()
+    @mock.patch('subprocess.check_output')
+    def test_detects_from_os_release(self, check_output):
+        self._write_os_release(dedent("""\
+            NAME="CentOS Linux"
+            ID="centos"
+            ID_LIKE="rhel fedora"
+            """))
+        depends = Depends("")
+        self.assertEqual(["platform:centos"], depends.platform_profiles())
+        self.assertEqual(0, check_output.call_count)
+
+    @mock.patch('bindep.depends._OS_RELEASE', '/nonexistent/os-release')
+    @mock.patch('subprocess.check_output', return_value=b"Ubuntu\n")
+    def test_detects_ubuntu(self, check_output):
         depends = Depends("")
         self.assertThat(
             depends.platform_profiles(), Contains("platform:ubuntu"))
+        check_output.assert_called_once_with(
+            ["lsb_release", "-si"], stderr=subprocess.STDOUT)
 
-    def test_ubuntu_implies_dpkg(self):
-        self._mock_lsb()
+    @mock.patch('bindep.depends._OS_RELEASE', '/nonexistent/os-release')
+    @mock.patch('subprocess.check_output', return_value=b"Ubuntu\n")
+    def test_ubuntu_implies_dpkg(self, check_output):
         depends = Depends("")
         self.assertThat(
             depends.platform_profiles(), Contains("platform:dpkg"))
         self.assertIsInstance(depends.platform, Dpkg)
 
+    @mock.patch('bindep.depends._OS_RELEASE', '/nonexistent/os-release')
+    @mock.patch('subprocess.check_output', return_value=b"Ubuntu\n")
+    def test_platform_detected_once(self, check_output):
+        depends = Depends("")
+        self.assertEqual(
+            depends.platform_profiles(), depends.platform_profiles())
+        self.assertEqual(
+            depends.platform_profiles(), Depends("").platform_profiles())
+        self.assertEqual(1, check_output.call_count)
+
     def test_finds_profiles(self):
         depends = Depends(dedent("""\
             foo
@@ -90,6 +119,63 @@ class TestDepends(TestCase):
             [("foo", [], [('<=', '1'), ('!=', '2')])],
             depends._rules)
 
+    def test_lines(self):
+        depends = Depends(["foo\n", "bar [baz] >=1"])
+        self.assertEqual(
+            [("foo", [], []), ("bar", [(True, "baz")], [(">=", "1")])],
+            depends._rules)
+
+    def test_bytes_lines(self):
+        depends = Depends([b"foo [!bar] <=1,!=2\n"])
+        self.assertEqual(
+            [("foo", [(False, "bar")], [('<=', '1'), ('!=', '2')])],
+            depends._rules)
+
+    def test_epoch_and_revision(self):
+        depends = Depends("foo >=1:2.0~rc1-0ubuntu1,<3\n")
+        self.assertEqual(
+            [("foo", [], [('>=', '1:2.0~rc1-0ubuntu1'), ('<', '3')])],
+            depends._rules)
+
+    def test_unicode(self):
+        depends = Depends(u"foo [!bar] <=1\n")
+        self.assertEqual(
+            [(u"foo", [(False, u"bar")], [(u'<=', u'1')])], depends._rules)
+
+    def test_os_release_id_selectors(self):
+        depends = Depends("foo [platform:opensuse-leap !platform:sl_e.s]\n")
+        self.assertEqual(
+            [("foo",
+              [(True, "platform:opensuse-leap"), (False, "platform:sl_e.s")],
+              [])],
+            depends._rules)
+        self.assertEqual(
+            [("foo",
+              [(True, "platform:opensuse-leap"), (False, "platform:sl_e.s")],
+              [])],
+            depends.active_rules(["platform:opensuse-leap"]))
+
+    def test_invalid_rule(self):
+        self.assertRaises(ValueError, Depends, "Foo\n")
+        self.assertRaises(ValueError, Depends, "foo =>1\n")
+        self.assertRaises(ValueError, Depends, "foo <=abc\n")
+        self.assertRaises(ValueError, Depends, "foo <=1-\n")
+        self.assertRaises(ValueError, Depends, "foo []\n")
+        self.assertRaises(ValueError, Depends, "foo [!]\n")
+        self.assertRaises(ValueError, Depends, "foo [bar !]\n")
+        self.assertRaises(ValueError, Depends, "foo[bar]\n")
+        self.assertRaises(ValueError, Depends, "foo<=1\n")
+        self.assertRaises(ValueError, Depends, "foo\t<=1\n")
+        self.assertRaises(ValueError, Depends, "foo [bar]\t<=1\n")
+        self.assertRaises(ValueError, Depends, "foo [bar\tbaz]\n")
+        self.assertRaises(ValueError, Depends, "foo \n")
+
+    def test_constraints_resolved(self):
+        depends = Depends("foo <=1,!=2\n")
+        self.assertEqual(
+            [(_COMPARATORS['<='], '<=', '1'), (_COMPARATORS['!='], '!=', '2')],
+            depends._rules[0].constraints)
+
     def test_no_selector_active(self):
         depends = Depends("foo\n")
         self.assertEqual([("foo", [], [])], depends.active_rules(["default"]))
@@ -104,89 +190,145 @@ class TestDepends(TestCase):
             [("foo", [(True, "on")], [])],
             depends.active_rules(["on", "off"]))
 
+    def test_any_positive_selector_includes_rule(self):
+        depends = Depends("foo [!bar baz quux]\n")
+        self.assertEqual(
+            [("foo", [(False, "bar"), (True, "baz"), (True, "quux")], [])],
+            depends.active_rules(["quux"]))
+        self.assertEqual([], depends.active_rules(["bar", "quux"]))
+
     def test_positive_selector_not_in_profiles_inactive(self):
         depends = Depends("foo [on]\n")
         self.assertEqual([], depends.active_rules(["default"]))
 
     def test_check_rule_missing(self):
         depends = Depends("")
-        mocker = mox.Mox()
-        depends.platform = mocker.CreateMock(Platform)
-        depends.platform.get_pkg_version("foo").AndReturn(None)
-        mocker.ReplayAll()
-        self.addCleanup(mocker.VerifyAll)
+        depends.platform = mock.Mock(spec=Platform)
+        depends.platform.installed_packages.return_value = {}
         self.assertEqual(
             [('missing', ['foo'])], depends.check_rules([("foo", [], [])]))
 
+    def test_check_rule_missing_ignores_constraints(self):
+        depends = Depends("")
+        depends.platform = mock.Mock(spec=Platform)
+        depends.platform.installed_packages.return_value = {}
+        self.assertEqual(
+            [('missing', ['foo'])],
+            depends.check_rules([("foo", [], [("<", "1")])]))
+
     def test_check_rule_present(self):
         depends = Depends("")
-        mocker = mox.Mox()
-        depends.platform = mocker.CreateMock(Platform)
-        depends.platform.get_pkg_version("foo").AndReturn("123")
-        mocker.ReplayAll()
-        self.addCleanup(mocker.VerifyAll)
+        depends.platform = mock.Mock(spec=Platform)
+        depends.platform.installed_packages.return_value = {"foo": "123"}
         self.assertEqual([], depends.check_rules([("foo", [], [])]))
 
     def test_check_rule_incompatible(self):
         depends = Depends("")
-        mocker = mox.Mox()
-        depends.platform = mocker.CreateMock(Platform)
-        depends.platform.get_pkg_version("foo").AndReturn("123")
-        mocker.ReplayAll()
-        self.addCleanup(mocker.VerifyAll)
+        depends.platform = mock.Mock(spec=Platform)
+        depends.platform.installed_packages.return_value = {"foo": "123"}
         self.assertEqual(
             [('badversion', [('foo', "!=123", "123")])],
             depends.check_rules([("foo", [], [("!=", "123")])]))
 
+    def test_check_parsed_rules(self):
+        depends = Depends("foo >=2\nbar <2\n")
+        depends.platform = mock.Mock(spec=Platform)
+        depends.platform.installed_packages.return_value = {
+            "foo": "1", "bar": "1"}
+        self.assertEqual(
+            [('badversion', [('foo', '>=2', '1')])],
+            depends.check_rules(depends.active_rules(["default"])))
+
+    def test_check_rules_stop_on_first(self):
+        depends = Depends("")
+        depends.platform = mock.Mock(spec=Platform)
+        depends.platform.installed_packages.return_value = {"bar": "1"}
+        rules = [("foo", [], []), ("bar", [], [("<", "1")]), ("baz", [], [])]
+        self.assertEqual(
+            [('missing', ['baz', 'foo']),
+             ('badversion', [('bar', '<1', '1')])],
+            depends.check_rules(rules))
+        self.assertEqual(
+            [('missing', ['foo'])],
+            depends.check_rules(rules, stop_on_first=True))
+
 
 class TestDpkg(TestCase):
 
+    def _mock_dpkg_query(self, output):
+        # check_output returns bytes, as the real one does.
+        patcher = mock.patch(
+            'subprocess.check_output', return_value=output.encode('utf-8'))
+        check_output = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(
+            check_output.assert_called_once_with,
+            ["dpkg-query", "-W", "-f", "${Package} ${Status} ${Version}\n"])
+
     def test_not_installed(self):
         platform = Dpkg()
-        mocker = mox.Mox()
-        mocker.StubOutWithMock(subprocess, "check_output")
-        subprocess.check_output(
-            ["dpkg-query", "-W", "-f",
-             "${binary:Package} ${Status} ${Version}\n", "foo"],
-            stderr=subprocess.STDOUT).AndReturn(
-                "foo deinstall ok config-files 4.0.0-0ubuntu1\n")
-        mocker.ReplayAll()
-        self.addCleanup(mocker.VerifyAll)
-        self.addCleanup(mocker.UnsetStubs)
+        self._mock_dpkg_query(
+            "foo deinstall ok config-files 4.0.0-0ubuntu1\n")
         self.assertEqual(None, platform.get_pkg_version("foo"))
 
     def test_unknown_package(self):
         platform = Dpkg()
-        mocker = mox.Mox()
-        mocker.StubOutWithMock(subprocess, "check_output")
-        subprocess.check_output(
-            ["dpkg-query", "-W", "-f",
-             "${binary:Package} ${Status} ${Version}\n", "foo"],
-            stderr=subprocess.STDOUT).AndRaise(
-                subprocess.CalledProcessError(
-                    1, [], "dpkg-query: no packages found matching foo\n"))
-        mocker.ReplayAll()
-        self.addCleanup(mocker.VerifyAll)
-        self.addCleanup(mocker.UnsetStubs)
+        self._mock_dpkg_query("bar install ok installed 1.0\n")
         self.assertEqual(None, platform.get_pkg_version("foo"))
 
     def test_installed_version(self):
         platform = Dpkg()
-        mocker = mox.Mox()
-        mocker.StubOutWithMock(subprocess, "check_output")
-        subprocess.check_output(
-            ["dpkg-query", "-W", "-f",
-             "${binary:Package} ${Status} ${Version}\n", "foo"],
-            stderr=subprocess.STDOUT).AndReturn(
-                "foo install ok installed 4.0.0-0ubuntu1\n")
-        mocker.ReplayAll()
-        self.addCleanup(mocker.VerifyAll)
-        self.addCleanup(mocker.UnsetStubs)
+        self._mock_dpkg_query("foo install ok installed 4.0.0-0ubuntu1\n")
         self.assertEqual("4.0.0-0ubuntu1", platform.get_pkg_version("foo"))
 
+    def test_single_query(self):
+        platform = Dpkg()
+        self._mock_dpkg_query(dedent("""\
+            foo install ok installed 4.0.0-0ubuntu1
+            bar install ok installed 1.0
+            baz deinstall ok config-files 2.0
+            """))
+        self.assertEqual("4.0.0-0ubuntu1", platform.get_pkg_version("foo"))
+        self.assertEqual("1.0", platform.get_pkg_version("bar"))
+        self.assertEqual(None, platform.get_pkg_version("baz"))
+        self.assertEqual(None, platform.get_pkg_version("quux"))
+
+    def test_malformed_lines_ignored(self):
+        platform = Dpkg()
+        self._mock_dpkg_query(dedent("""\
+            dpkg-query: warning: short line
+            foo install ok installed 4.0.0-0ubuntu1
+
+            """))
+        self.assertEqual(
+            {"foo": "4.0.0-0ubuntu1"}, platform.installed_packages())
+
+    def test_installed_packages(self):
+        platform = Dpkg()
+        self._mock_dpkg_query(dedent("""\
+            foo install ok installed 4.0.0-0ubuntu1
+            baz deinstall ok config-files 2.0
+            """))
+        self.assertEqual(
+            {"foo": "4.0.0-0ubuntu1"}, platform.installed_packages())
+
 
 class TestEval(TestCase):
 
+    def test_cached(self):
+        self.addCleanup(_cmp_version.cache_clear)
+        parsed = []
+
+        def parse(version):
+            parsed.append(version)
+            return ("0", version, "")
+        self.useFixture(
+            MonkeyPatch('bindep.depends._parse_debversion', parse))
+        _cmp_version.cache_clear()
+        self.assertEqual(True, _eval("1", "<", "2"))
+        self.assertEqual(True, _eval("1", "<=", "2"))
+        self.assertEqual(["2", "1"], parsed)
+
     def test_lt(self):
         self.assertEqual(True, _eval("3.5-ubuntu", "<", "4"))
         self.assertEqual(False, _eval("4", "<", "3.5-ubuntu"))
@@ -22,7 +22,9 @@ from fixtures import FakeLogger
 from fixtures import Fixture
 from fixtures import MonkeyPatch
 from fixtures import TempDir
-import mox
+import mock
+from testtools.matchers import EndsWith
+from testtools.matchers import StartsWith
 from testtools import TestCase
 
 from bindep.depends import Depends
@@ -67,6 +69,20 @@ class TestMain(TestCase):
             foo
             """), logger.output)
 
+    def test_help(self):
+        logger = self.useFixture(FakeLogger())
+        self.useFixture(MonkeyPatch('sys.argv', ['bindep', '--help']))
+        self.assertEqual(0, main(depends=object()))
+        self.assertThat(logger.output, StartsWith("Usage: bindep"))
+
+    def test_unknown_option(self):
+        logger = self.useFixture(FakeLogger())
+        self.useFixture(MonkeyPatch('sys.argv', ['bindep', '--bogus']))
+        self.assertEqual(2, main(depends=object()))
+        self.assertThat(
+            logger.output,
+            EndsWith("bindep: error: no such option: --bogus\n"))
+
     def test_missing_requirements_file(self):
         fixture = self.useFixture(MainFixture())
         self.useFixture(MonkeyPatch('sys.argv', ['bindep']))
@@ -85,42 +101,52 @@ class TestMain(TestCase):
     def test_specific_profile(self):
         logger = self.useFixture(FakeLogger())
         self.useFixture(MonkeyPatch('sys.argv', ['bindep', 'myprofile']))
-        mocker = mox.Mox()
-        depends = mocker.CreateMock(Depends)
-        depends.platform_profiles().AndReturn(["platform:ubuntu"])
-        depends.active_rules(["myprofile", "platform:ubuntu"]).AndReturn([""])
-        depends.check_rules([""]).AndReturn([])
-        mocker.ReplayAll()
+        depends = mock.Mock(spec=Depends)
+        depends.platform_profiles.return_value = ["platform:ubuntu"]
+        depends.active_rules.return_value = [""]
+        depends.check_rules.return_value = []
         self.assertEqual(0, main(depends=depends))
         self.assertEqual("", logger.output)
-        self.addCleanup(mocker.VerifyAll)
-        self.addCleanup(mocker.UnsetStubs)
+        depends.active_rules.assert_called_once_with(
+            ["myprofile", "platform:ubuntu"])
+        depends.check_rules.assert_called_once_with([""], stop_on_first=False)
 
     def test_default_profile(self):
         logger = self.useFixture(FakeLogger())
         self.useFixture(MonkeyPatch('sys.argv', ['bindep']))
-        mocker = mox.Mox()
-        depends = mocker.CreateMock(Depends)
-        depends.platform_profiles().AndReturn(["platform:ubuntu"])
-        depends.active_rules(["default", "platform:ubuntu"]).AndReturn(["A"])
-        depends.check_rules(["A"]).AndReturn([])
-        mocker.ReplayAll()
+        depends = mock.Mock(spec=Depends)
+        depends.platform_profiles.return_value = ["platform:ubuntu"]
+        depends.active_rules.return_value = ["A"]
+        depends.check_rules.return_value = []
         self.assertEqual(0, main(depends=depends))
         self.assertEqual("", logger.output)
-        self.addCleanup(mocker.VerifyAll)
-        self.addCleanup(mocker.UnsetStubs)
+        depends.active_rules.assert_called_once_with(
+            ["default", "platform:ubuntu"])
+        depends.check_rules.assert_called_once_with(["A"], stop_on_first=False)
+
+    def test_fail_fast(self):
+        logger = self.useFixture(FakeLogger())
+        self.useFixture(MonkeyPatch('sys.argv', ['bindep', '--fail-fast']))
+        depends = mock.Mock(spec=Depends)
+        depends.platform_profiles.return_value = []
+        depends.active_rules.return_value = ["A"]
+        depends.check_rules.return_value = [('missing', ['foo'])]
+        self.assertEqual(1, main(depends=depends))
+        self.assertEqual(dedent("""\
+            Missing packages:
+                foo
+            """), logger.output)
+        depends.check_rules.assert_called_once_with(["A"], stop_on_first=True)
 
     def test_errors_shown(self):
         logger = self.useFixture(FakeLogger())
         self.useFixture(MonkeyPatch('sys.argv', ['bindep']))
-        mocker = mox.Mox()
-        depends = mocker.CreateMock(Depends)
-        depends.platform_profiles().AndReturn([])
-        depends.active_rules(["default"]).AndReturn([])
-        depends.check_rules([]).AndReturn(
-            [('missing', ['foo', 'bar']),
-             ('badversion', [('quux', '<=12', '13'), ('qaaz', '!=10', '10')])])
-        mocker.ReplayAll()
+        depends = mock.Mock(spec=Depends)
+        depends.platform_profiles.return_value = []
+        depends.active_rules.return_value = []
+        depends.check_rules.return_value = [
+            ('missing', ['foo', 'bar']),
+            ('badversion', [('quux', '<=12', '13'), ('qaaz', '!=10', '10')])]
         self.assertEqual(1, main(depends=depends))
         self.assertEqual(dedent("""\
             Missing packages:
@@ -129,6 +155,5 @@ class TestMain(TestCase):
                 quux version 13 does not match <=12
                 qaaz version 10 does not match !=10
             """), logger.output)
-        self.addCleanup(mocker.VerifyAll)
-        self.addCleanup(mocker.UnsetStubs)
+        depends.active_rules.assert_called_once_with(["default"])
 